@@ -689,6 +689,7 @@ def run_interventions(
         eval_results_batch_size,
         device,
         overwrite_prev_results=p_config.force_eval_results_recompute,
+        token_cache_dir=os.path.join(p_config.dictionaries_path, "tokenized_inputs"),
     )
 
     if p_config.use_autointerp:
@@ -1,8 +1,12 @@
 import torch
+import numpy as np
 from nnsight import LanguageModel
 from datasets import load_dataset
+import hashlib
 import json
 import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 
 import experiments.utils as utils
 from dictionary_learning.buffer import ActivationBuffer
@@ -16,7 +20,181 @@ else:
     tracer_kwargs = dict(scan=False, validate=False)
 
 
-@torch.no_grad()
+def get_tokenized_inputs_digest(tokenizer, input_strings: list[str], context_length: int) -> str:
+    """Digest of everything that determines the output of get_tokenized_inputs()."""
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update(tokenizer.name_or_path.encode())
+    hasher.update(tokenizer.padding_side.encode())
+    hasher.update(str(context_length).encode())
+    for text in input_strings:
+        hasher.update(text.encode())
+        hasher.update(b"\0")
+    return hasher.hexdigest()
+
+
+def get_tokenized_inputs(
+    tokenizer, input_strings: list[str], context_length: int, cache_dir: Optional[str] = None
+) -> tuple[np.ndarray, np.ndarray]:
+    """Returns token ids of shape [n_inputs, context_length] and the number of non-padding tokens of every input.
+    If cache_dir is passed, they are cached there as .npy files."""
+    if cache_dir is not None:
+        digest = get_tokenized_inputs_digest(tokenizer, input_strings, context_length)
+        tokens_filename = os.path.join(cache_dir, f"{digest}_tokens.npy")
+        lengths_filename = os.path.join(cache_dir, f"{digest}_lengths.npy")
+
+        if os.path.exists(tokens_filename) and os.path.exists(lengths_filename):
+            return np.load(tokens_filename, mmap_mode="r"), np.load(lengths_filename)
+
+    print(f"Tokenizing {len(input_strings)} inputs")
+    tokenized = tokenizer(
+        input_strings,
+        truncation=True,
+        max_length=context_length,
+        padding="max_length",
+        return_tensors="np",
+    )
+    tokens_NL = tokenized["input_ids"].astype(np.int32)
+    lengths_N = tokenized["attention_mask"].sum(axis=1).astype(np.int32)
+
+    if cache_dir is not None:
+        print(f"Saving tokenized inputs to {tokens_filename}")
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write to temporary files first so an interrupted run never leaves a truncated cache entry
+        mmap_tokens_NL = np.lib.format.open_memmap(
+            f"{tokens_filename}.tmp", mode="w+", dtype=np.int32, shape=tokens_NL.shape
+        )
+        mmap_tokens_NL[:] = tokens_NL
+        mmap_tokens_NL.flush()
+        del mmap_tokens_NL
+        os.replace(f"{tokens_filename}.tmp", tokens_filename)
+
+        with open(f"{lengths_filename}.tmp", "wb") as f:
+            np.save(f, lengths_N)
+        os.replace(f"{lengths_filename}.tmp", lengths_filename)
+
+    return tokens_NL, lengths_N
+
+
+def get_truncated_inputs(
+    tokenizer, input_strings: list[str], tokens_NL: np.ndarray, lengths_N: np.ndarray
+) -> list[str]:
+    """ActivationBuffer only accepts strings, so we give it the decoded truncated inputs. Where re-tokenizing one
+    doesn't give back its tokens (e.g. a cut mid-word or mid-character), we give it the full input instead."""
+    added_prefix_L = tokenizer("")["input_ids"]
+    truncated_strings = []
+    for tokens_L, length in zip(tokens_NL, lengths_N):
+        if tokenizer.padding_side == "left":
+            tokens_L = tokens_L[len(tokens_L) - length :]
+        else:
+            tokens_L = tokens_L[:length]
+        # The tokenizer adds these again when re-tokenizing
+        if added_prefix_L and list(tokens_L[: len(added_prefix_L)]) == added_prefix_L:
+            tokens_L = tokens_L[len(added_prefix_L) :]
+        truncated_strings.append(
+            tokenizer.decode(tokens_L, skip_special_tokens=False, clean_up_tokenization_spaces=False)
+        )
+
+    retokenized_NL = tokenizer(
+        truncated_strings,
+        truncation=True,
+        max_length=tokens_NL.shape[1],
+        padding="max_length",
+        return_tensors="np",
+    )["input_ids"]
+    round_trips_N = (retokenized_NL == tokens_NL).all(axis=1)
+
+    return [
+        truncated_string if round_trips else input_string
+        for truncated_string, input_string, round_trips in zip(
+            truncated_strings, input_strings, round_trips_N
+        )
+    ]
+
+
+class ReplayActivationBuffer(ActivationBuffer):
+    """Records the activation and text batches evaluate() draws from an ActivationBuffer and replays them."""
+
+    def __init__(
+        self, activation_buffer: ActivationBuffer, n_batches: int, text_batch_size: int, device: str
+    ):
+        # ActivationBuffer.__init__ is deliberately not called, it would allocate and fill a new buffer.
+        # We keep the non-tensor attributes (model, submodule, io, ...) evaluate() may read.
+        self.__dict__.update(
+            {
+                key: value
+                for key, value in vars(activation_buffer).items()
+                if not isinstance(value, torch.Tensor)
+            }
+        )
+        self.device = device
+
+        use_cuda = torch.device(device).type == "cuda"
+        d2h_stream = torch.cuda.Stream(device=device) if use_cuda else None
+
+        self.activations_cache = None
+        self.text_batches = []
+        for i in range(n_batches):
+            acts = next(activation_buffer)
+            if self.activations_cache is None:
+                # Pinned, so replaying a batch to the GPU is an asynchronous copy
+                self.activations_cache = torch.empty(
+                    (n_batches, *acts.shape), dtype=acts.dtype, pin_memory=use_cuda
+                )
+
+            if use_cuda:
+                d2h_stream.wait_stream(torch.cuda.current_stream(device))
+                with torch.cuda.stream(d2h_stream):
+                    self.activations_cache[i].copy_(acts, non_blocking=True)
+                acts.record_stream(d2h_stream)
+            else:
+                self.activations_cache[i].copy_(acts)
+
+            # evaluate() draws one text batch after every activation batch
+            self.text_batches.append(activation_buffer.text_batch(batch_size=text_batch_size))
+
+        if use_cuda:
+            d2h_stream.synchronize()
+
+        self.reset()
+
+    def reset(self):
+        self.batch_idx = 0
+        self.text_batch_idx = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.batch_idx >= len(self.activations_cache):
+            raise StopIteration
+        acts = self.activations_cache[self.batch_idx].to(self.device, non_blocking=True)
+        self.batch_idx += 1
+        return acts
+
+    def text_batch(self, batch_size=None):
+        texts = self.text_batches[self.text_batch_idx]
+        self.text_batch_idx += 1
+        return texts
+
+
+def load_eval_input_strings() -> list[str]:
+    # We keep all inputs, the ActivationBuffer consumes more than n_inputs of them
+    pile_dataset = load_dataset("NeelNanda/pile-10k", streaming=False)
+    return list(pile_dataset["train"]["text"])
+
+
+def load_dictionary_on_stream(
+    model: LanguageModel, ae_path: str, device: str, load_stream: Optional[torch.cuda.Stream]
+):
+    """Runs utils.load_dictionary() with its host to device copies queued on load_stream."""
+    if load_stream is None:
+        return utils.load_dictionary(model, ae_path, device)
+
+    with torch.cuda.stream(load_stream):
+        return utils.load_dictionary(model, ae_path, device)
+
+
+@torch.inference_mode()
 def eval_saes(
     model: LanguageModel,
     ae_paths: list[str],
@@ -25,7 +203,10 @@ def eval_saes(
     device: str,
     overwrite_prev_results: bool = False,
     transcoder: bool = False,
+    token_cache_dir: Optional[str] = None,
+    input_strings: Optional[list[str]] = None,
 ) -> dict:
+    """input_strings defaults to load_eval_input_strings(). token_cache_dir is passed to get_tokenized_inputs()."""
     buffer_size = min(512, n_inputs)
     n_batches = n_inputs // llm_batch_size
 
@@ -34,57 +215,101 @@ def eval_saes(
     else:
         io = "out"
 
-    pile_dataset = load_dataset("NeelNanda/pile-10k", streaming=False)
-
-    input_strings = []
-
-    for i, example in enumerate(pile_dataset["train"]["text"]):
-        input_strings.append(example)
-
     eval_results = {}
+    truncated_inputs = {}
+    replay_buffer_key = None
+    replay_buffer = None
 
+    ae_paths_to_eval = []
     for ae_path in ae_paths:
         output_filename = f"{ae_path}/eval_results.json"
         if not overwrite_prev_results:
             if os.path.exists(output_filename):
                 print(f"Skipping {ae_path} as eval results already exist")
                 continue
-
-        submodule, dictionary, config = utils.load_dictionary(model, ae_path, device)
-
-        activation_dim = config["trainer"]["activation_dim"]
-        # TODO: Think about how to handle context length... should we instead use the same context length for all dictionaries?
-        context_length = config["buffer"]["ctx_len"]
-
-        activation_buffer_data = iter(input_strings)
-
-        activation_buffer = ActivationBuffer(
-            activation_buffer_data,
-            model,
-            submodule,
-            n_ctxs=buffer_size,
-            ctx_len=context_length,
-            refresh_batch_size=llm_batch_size,
-            out_batch_size=llm_batch_size,
-            io=io,
-            d_submodule=activation_dim,
-            device=device,
-        )
-
-        eval_results = evaluate(
-            dictionary, activation_buffer, context_length, llm_batch_size, io=io, device=device, n_batches=n_batches
-        )
-
-        hyperparameters = {
-            "n_inputs": n_inputs,
-            "context_length": context_length,
-        }
-        eval_results["hyperparameters"] = hyperparameters
-
-        print(eval_results)
-
-        with open(output_filename, "w") as f:
-            json.dump(eval_results, f)
+        ae_paths_to_eval.append(ae_path)
+
+    # The dataset is only loaded if there is an SAE left to evaluate
+    if input_strings is None and ae_paths_to_eval:
+        input_strings = load_eval_input_strings()
+
+    use_cuda = torch.device(device).type == "cuda"
+    load_stream = torch.cuda.Stream(device=device) if use_cuda else None
+    # One worker loads the next SAE while the current one is evaluated. The with block shuts it down even if
+    # evaluating an SAE raises
+    with ThreadPoolExecutor(max_workers=1) as load_executor:
+        if ae_paths_to_eval:
+            next_dictionary = load_executor.submit(
+                load_dictionary_on_stream, model, ae_paths_to_eval[0], device, load_stream
+            )
+
+        for i, ae_path in enumerate(ae_paths_to_eval):
+            output_filename = f"{ae_path}/eval_results.json"
+
+            submodule, dictionary, config = next_dictionary.result()
+            if use_cuda:
+                current_stream = torch.cuda.current_stream(device)
+                current_stream.wait_stream(load_stream)
+                for tensor in list(dictionary.parameters()) + list(dictionary.buffers()):
+                    # The weights were allocated on load_stream but are used on current_stream
+                    tensor.record_stream(current_stream)
+
+            if i + 1 < len(ae_paths_to_eval):
+                next_dictionary = load_executor.submit(
+                    load_dictionary_on_stream, model, ae_paths_to_eval[i + 1], device, load_stream
+                )
+
+            activation_dim = config["trainer"]["activation_dim"]
+            # TODO: Think about how to handle context length... should we instead use the same context length for all dictionaries?
+            context_length = config["buffer"]["ctx_len"]
+
+            # SAEs on the same submodule and context length see the same activations, so we only run the LLM once
+            buffer_key = (config["trainer"]["submodule_name"], config["trainer"]["layer"], context_length)
+            if buffer_key != replay_buffer_key:
+                if context_length not in truncated_inputs:
+                    tokens_NL, lengths_N = get_tokenized_inputs(
+                        model.tokenizer, input_strings, context_length, token_cache_dir
+                    )
+                    truncated_inputs[context_length] = get_truncated_inputs(
+                        model.tokenizer, input_strings, tokens_NL, lengths_N
+                    )
+
+                activation_buffer = ActivationBuffer(
+                    iter(truncated_inputs[context_length]),
+                    model,
+                    submodule,
+                    n_ctxs=buffer_size,
+                    ctx_len=context_length,
+                    refresh_batch_size=llm_batch_size,
+                    out_batch_size=llm_batch_size,
+                    io=io,
+                    d_submodule=activation_dim,
+                    device=device,
+                )
+
+                replay_buffer = None  # Free the previous group's activations first
+                replay_buffer = ReplayActivationBuffer(
+                    activation_buffer, n_batches, llm_batch_size, device
+                )
+                replay_buffer_key = buffer_key
+                del activation_buffer
+
+            replay_buffer.reset()
+
+            eval_results = evaluate(
+                dictionary, replay_buffer, context_length, llm_batch_size, io=io, device=device, n_batches=n_batches
+            )
+
+            hyperparameters = {
+                "n_inputs": n_inputs,
+                "context_length": context_length,
+            }
+            eval_results["hyperparameters"] = hyperparameters
+
+            print(eval_results)
+
+            with open(output_filename, "w") as f:
+                json.dump(eval_results, f)
 
     # return the final eval_results for testing purposes
     return eval_results
@@ -115,12 +340,16 @@ if __name__ == "__main__":
     ae_group_paths = utils.get_ae_group_paths(dictionaries_path, sweep_name, submodule_trainers)
     ae_paths = utils.get_ae_paths(ae_group_paths)
 
+    input_strings = load_eval_input_strings()
+
     eval_results = eval_saes(
         model,
         ae_paths,
         n_inputs,
         llm_batch_size,
         DEVICE,
+        token_cache_dir=os.path.join(dictionaries_path, "tokenized_inputs"),
+        input_strings=input_strings,
     )
 
     print(f"Final eval results: {eval_results}")
@@ -4,6 +4,9 @@ import sys
 import os
 import random
 import gc
+from dataclasses import dataclass
+import functools
+import hashlib
 from collections import defaultdict
 import einops
 import math
@@ -12,7 +15,6 @@ import pickle
 
 import torch as t
 from torch import nn
-import pandas as pd
 import matplotlib.pyplot as plt
 from sklearn.utils import shuffle
 from tqdm import tqdm
@@ -34,13 +36,19 @@ sys.path.append(parent_dir)
 
 tracer_kwargs = dict(scan=DEBUGGING, validate=DEBUGGING)
 
+# Activations are only used to train and evaluate linear probes, so bfloat16 is plenty and halves their memory
+ACTIVATIONS_DTYPE = t.bfloat16
+
 
 # Load and prepare dataset
 def load_and_prepare_dataset():
+    """Returns the dataset and its train split with a combined_label column, equal to profession * 2 + gender."""
     dataset = load_dataset("LabHC/bias_in_bios")
-    df = pd.DataFrame(dataset["train"])
-    df["combined_label"] = df["profession"].astype(str) + "_" + df["gender"].astype(str)
-    return dataset, df
+    train_split = dataset["train"]
+    professions = np.asarray(train_split["profession"])
+    genders = np.asarray(train_split["gender"])
+    train_split = train_split.add_column("combined_label", professions * 2 + genders)
+    return dataset, train_split
 
 
 # Profession dictionary
@@ -78,11 +86,13 @@ profession_dict_rev = {v: k for k, v in profession_dict.items()}
 
 
 # Visualization
-def plot_label_distribution(df):
-    label_counts = df["combined_label"].value_counts().sort_index()
+def plot_label_distribution(train_split):
+    combined_labels, label_counts = np.unique(
+        np.asarray(train_split["combined_label"]), return_counts=True
+    )
     labels = [
-        f"{profession_dict_rev[int(label.split('_')[0])]} ({'Male' if label.split('_')[1] == '0' else 'Female'})"
-        for label in label_counts.index
+        f"{profession_dict_rev[int(label // 2)]} ({'Male' if label % 2 == 0 else 'Female'})"
+        for label in combined_labels
     ]
 
     plt.figure(figsize=(12, 8))
@@ -96,7 +106,7 @@ def plot_label_distribution(df):
 
 
 def add_gender_classes(
-    balanced_data: dict, df: pd.DataFrame, cutoff: int, random_seed: int
+    balanced_data: dict, split: datasets.Dataset, cutoff: int, random_seed: int
 ) -> dict:
     # TODO: Experiment with more professions
 
@@ -105,22 +115,22 @@ def add_gender_classes(
     professor_idx = profession_dict["professor"]
     nurse_idx = profession_dict["nurse"]
 
-    male_nurse = df[(df["profession"] == nurse_idx) & (df["gender"] == MALE_IDX)][
-        "hard_text"
-    ].tolist()
-    female_nurse = df[(df["profession"] == nurse_idx) & (df["gender"] == FEMALE_IDX)][
-        "hard_text"
-    ].tolist()
+    professions = np.asarray(split["profession"])
+    genders = np.asarray(split["gender"])
+
+    def get_texts(profession: int, gender: int) -> tuple[list[str], int]:
+        """Returns the first 2 * cutoff texts, which is all we use, and the total number available."""
+        indices = np.where((professions == profession) & (genders == gender))[0]
+        return list(split.select(indices[: cutoff * 2])["hard_text"]), len(indices)
+
+    male_nurse, num_male_nurse = get_texts(nurse_idx, MALE_IDX)
+    female_nurse, num_female_nurse = get_texts(nurse_idx, FEMALE_IDX)
 
-    male_professor = df[(df["profession"] == professor_idx) & (df["gender"] == MALE_IDX)][
-        "hard_text"
-    ].tolist()
-    female_professor = df[(df["profession"] == professor_idx) & (df["gender"] == FEMALE_IDX)][
-        "hard_text"
-    ].tolist()
+    male_professor, num_male_professor = get_texts(professor_idx, MALE_IDX)
+    female_professor, num_female_professor = get_texts(professor_idx, FEMALE_IDX)
 
     min_count = min(
-        len(male_nurse), len(female_nurse), len(male_professor), len(female_professor), cutoff
+        num_male_nurse, num_female_nurse, num_male_professor, num_female_professor, cutoff
     )
 
     assert min_count == cutoff
@@ -176,31 +186,45 @@ def get_balanced_dataset(
     include_paired_classes: bool,
     random_seed: int = SEED,
 ):
-    df = pd.DataFrame(dataset["train" if train else "test"])
-    balanced_df_list = []
-
-    for profession in tqdm(df["profession"].unique()):
-        prof_df = df[df["profession"] == profession]
-        min_count = prof_df["gender"].value_counts().min()
-
-        if min_count < min_samples_per_group:
+    split = dataset["train" if train else "test"]
+    professions = np.asarray(split["profession"])
+    genders = np.asarray(split["gender"])
+
+    def sample_group(indices: np.ndarray) -> np.ndarray:
+        # The same draw as pandas' group.sample(n=min_samples_per_group, random_state=random_seed), which reseeds
+        # for every group, so we select the same bios as before
+        rng = np.random.RandomState(random_seed)
+        return indices[rng.choice(len(indices), size=min_samples_per_group, replace=False)]
+
+    balanced_indices = {}
+
+    # Sorted like the pandas groupby we replaced, so professions and genders keep their order
+    for profession in tqdm(np.unique(professions)):
+        prof_indices = np.where(professions == profession)[0]
+        prof_genders = genders[prof_indices]
+        gender_indices = [
+            prof_indices[prof_genders == gender] for gender in np.unique(prof_genders)
+        ]
+
+        if min(len(indices) for indices in gender_indices) < min_samples_per_group:
             continue
 
-        balanced_prof_df = pd.concat(
-            [
-                group.sample(n=min_samples_per_group, random_state=random_seed)
-                for _, group in prof_df.groupby("gender")
-            ]
-        ).reset_index(drop=True)
-        balanced_df_list.append(balanced_prof_df)
+        balanced_indices[int(profession)] = np.concatenate(
+            [sample_group(indices) for indices in gender_indices]
+        )
 
-    balanced_df = pd.concat(balanced_df_list).reset_index(drop=True)
-    grouped = balanced_df.groupby("profession")["hard_text"].apply(list)
+    # A single select() gathers the texts of all professions straight from the Arrow table
+    all_indices = np.concatenate(list(balanced_indices.values()))
+    balanced_texts = list(split.select(all_indices)["hard_text"])
 
-    balanced_data = {label: texts for label, texts in grouped.items()}
+    balanced_data = {}
+    offset = 0
+    for profession, indices in balanced_indices.items():
+        balanced_data[profession] = balanced_texts[offset : offset + len(indices)]
+        offset += len(indices)
 
     if include_paired_classes:
-        balanced_data = add_gender_classes(balanced_data, df, min_samples_per_group, random_seed)
+        balanced_data = add_gender_classes(balanced_data, split, min_samples_per_group, random_seed)
 
     for key in balanced_data.keys():
         balanced_data[key] = balanced_data[key][: min_samples_per_group * 2]
@@ -264,7 +288,7 @@ class Probe(nn.Module):
         self.net = nn.Linear(activation_dim, 1, bias=True, dtype=dtype)
 
     def forward(self, x):
-        return self.net(x).squeeze(-1)
+        return self.net(x.to(self.net.weight.dtype)).squeeze(-1)
 
 
 def get_acts(text):
@@ -278,12 +302,91 @@ def get_acts(text):
         return acts.value
 
 
-@t.no_grad()
+def get_activations_digest(text_inputs, model_name: str, model_dtype: str, cache_key: str) -> str:
+    """The submodule isn't hashed, callers encode it in cache_key."""
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update(model_name.encode())
+    hasher.update(model_dtype.encode())
+    hasher.update(cache_key.encode())
+
+    if isinstance(text_inputs, dict):
+        for key in ["input_ids", "attention_mask"]:
+            tokens = text_inputs[key]
+            hasher.update(str(tuple(tokens.shape)).encode())
+            hasher.update(tokens.cpu().numpy().tobytes())
+    else:
+        for text in text_inputs:
+            hasher.update(text.encode())
+            hasher.update(b"\0")
+
+    return hasher.hexdigest()
+
+
+def cache_activations(get_activations_fn: Callable) -> Callable:
+    """If cache_dir is passed, activations are saved to and reloaded from {cache_dir}/{digest}.pt."""
+
+    @functools.wraps(get_activations_fn)
+    def wrapper(
+        text_inputs,
+        model: LanguageModel,
+        batch_size: int,
+        submodule: utils.submodule_alias,
+        cache_dir: Optional[str] = None,
+        cache_key: str = "",
+    ) -> t.Tensor:
+        if cache_dir is None:
+            return get_activations_fn(text_inputs, model, batch_size, submodule)
+
+        digest = get_activations_digest(
+            text_inputs, model.config._name_or_path, str(model.dtype), cache_key
+        )
+        cache_filename = os.path.join(cache_dir, f"{digest}.pt")
+
+        if os.path.exists(cache_filename):
+            acts_bD = t.load(cache_filename, map_location="cpu", mmap=True, weights_only=True)
+            if model.device.type == "cuda":
+                acts_bD = acts_bD.pin_memory()
+            return acts_bD.to(model.device, non_blocking=True)
+
+        acts_bD = get_activations_fn(text_inputs, model, batch_size, submodule)
+
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write to a temporary file first so an interrupted run never leaves a truncated cache entry
+        tmp_filename = f"{cache_filename}.tmp"
+        t.save(acts_bD.cpu(), tmp_filename)
+        os.replace(tmp_filename, cache_filename)
+
+        return acts_bD
+
+    return wrapper
+
+
+# CUDA graphs are disabled as they hold on to their static output buffers between calls
+@t.compile(dynamic=True, options={"triton.cudagraphs": False})
+def masked_mean(acts_BLD: t.Tensor, attn_mask_BL: t.Tensor) -> t.Tensor:
+    """Mean over the non-padding positions of every sequence."""
+    attn_mask_BL = attn_mask_BL.to(acts_BLD.dtype)
+    acts_BD = t.einsum("bld,bl->bd", acts_BLD, attn_mask_BL)
+    return acts_BD / attn_mask_BL.sum(1, keepdim=True).clamp(min=1)
+
+
+@cache_activations
+@t.inference_mode()
 def get_all_activations(
     text_inputs: list[str], model: LanguageModel, batch_size: int, submodule: utils.submodule_alias
 ) -> t.Tensor:
     # TODO: Rename text_inputs
-    text_batches = utils.batch_inputs(text_inputs, batch_size)
+    sort_indices_b = None
+    if isinstance(text_inputs, dict):
+        text_batches, sort_indices_b = utils.batch_inputs_by_length(
+            text_inputs,
+            batch_size,
+            model.tokenizer.padding_side,
+            pin_memory=model.device.type == "cuda",
+        )
+        text_batches = utils.prefetch_to_device(text_batches, model.device)
+    else:
+        text_batches = utils.batch_inputs(text_inputs, batch_size)
 
     all_acts_list_BD = []
     for text_batch_BL in text_batches:
@@ -291,45 +394,146 @@ def get_all_activations(
             text_batch_BL,
             **tracer_kwargs,
         ):
-            attn_mask = model.input[1]["attention_mask"]
-            acts_BLD = submodule.output[0]
-            acts_BLD = acts_BLD * attn_mask[:, :, None]
-            acts_BD = acts_BLD.sum(1) / attn_mask.sum(1)[:, None]
-            acts_BD = acts_BD.save()
-        all_acts_list_BD.append(acts_BD.value)
+            attn_mask_BL = model.input[1]["attention_mask"].save()
+            acts_BLD = submodule.output[0].save()
+        acts_BD = masked_mean(acts_BLD.value, attn_mask_BL.value)
+        all_acts_list_BD.append(acts_BD)
 
     all_acts_bD = t.cat(all_acts_list_BD, dim=0)
+
+    if sort_indices_b is not None:
+        # Restore the original input order
+        all_acts_bD = all_acts_bD[t.argsort(sort_indices_b).to(all_acts_bD.device)]
+
     return all_acts_bD
 
 
-def prepare_probe_data(
-    all_activations: dict[int | str, t.Tensor],
-    class_idx: int | str,
+def get_all_class_activations(
+    class_texts: dict[int | str, list[str]],
+    model: LanguageModel,
     batch_size: int,
-) -> tuple[list[t.Tensor], list[t.Tensor]]:
-    """If class_idx is a string, there is a paired class idx in utils.py."""
-    positive_acts = all_activations[class_idx]
-    device = positive_acts.device
+    submodule: utils.submodule_alias,
+    context_length: int,
+    cache_dir: Optional[str] = None,
+    cache_key: str = "",
+) -> dict[int | str, t.Tensor]:
+    """Collects activations for all classes in a single pass, so LLM batches are always full."""
+    class_names = list(class_texts.keys())
+    class_sizes = [len(class_texts[class_name]) for class_name in class_names]
+    flat_texts = [text for class_name in class_names for text in class_texts[class_name]]
+
+    # Tokens stay on the CPU, get_all_activations() copies them over batch by batch
+    flat_tokens = utils.tokenize_data({"all": flat_texts}, model.tokenizer, context_length, "cpu")
+    flat_tokens = flat_tokens["all"]
+
+    all_acts_bD = get_all_activations(
+        flat_tokens,
+        model,
+        batch_size,
+        submodule,
+        cache_dir=cache_dir,
+        cache_key=cache_key,
+    )
+    # Only probe training stores bfloat16 activations. Other callers of get_all_activations() (e.g. the
+    # ablated activations in bib_intervention) keep the model's output dtype, so their results stay comparable
+    all_acts_bD = all_acts_bD.to(ACTIVATIONS_DTYPE)
 
-    num_positive = len(positive_acts)
+    return dict(zip(class_names, t.split(all_acts_bD, class_sizes)))
 
-    if isinstance(class_idx, int):
-        # Collect all negative class activations and labels
-        negative_acts = []
-        for idx, acts in all_activations.items():
-            if idx != class_idx and isinstance(idx, int):
-                negative_acts.append(acts)
 
-        negative_acts = t.cat(negative_acts)
+@dataclass
+class StackedActivations:
+    """Rows offsets[i] : offsets[i] + sizes[i] of acts_bD belong to class_names[i]."""
+
+    acts_bD: t.Tensor
+    class_ids_b: t.Tensor
+    class_names: list[int | str]
+    class_positions: dict[int | str, int]
+    offsets: list[int]
+    sizes: list[int]
+    # Rows of the integer profession classes, the negative pool of every profession probe
+    profession_rows_b: t.Tensor
+
+
+def stack_class_activations(all_activations: dict[int | str, t.Tensor]) -> StackedActivations:
+    class_names = list(all_activations.keys())
+    acts_bD = t.cat([all_activations[class_name] for class_name in class_names])
+    device = acts_bD.device
+
+    sizes = [len(all_activations[class_name]) for class_name in class_names]
+    offsets = np.cumsum([0] + sizes[:-1]).tolist()
+    class_ids_b = t.repeat_interleave(
+        t.arange(len(class_names), device=device), t.tensor(sizes, device=device)
+    )
+
+    is_profession_class = t.tensor(
+        [isinstance(class_name, int) for class_name in class_names], device=device
+    )
+
+    return StackedActivations(
+        acts_bD=acts_bD,
+        class_ids_b=class_ids_b,
+        class_names=class_names,
+        class_positions={class_name: i for i, class_name in enumerate(class_names)},
+        offsets=offsets,
+        sizes=sizes,
+        profession_rows_b=is_profession_class[class_ids_b],
+    )
+
+
+def get_class_rows(stacked: StackedActivations, class_idx: int | str) -> slice:
+    position = stacked.class_positions[class_idx]
+    return slice(stacked.offsets[position], stacked.offsets[position] + stacked.sizes[position])
+
+
+def sample_negative_indices(
+    stacked: StackedActivations, class_idx: int | str, num_samples: int
+) -> t.Tensor:
+    """Randomly selects num_samples rows of the stacked activations to use as negatives for class_idx."""
+    device = stacked.class_ids_b.device
+
+    if isinstance(class_idx, int):
+        # All other profession classes are negatives
+        negative_mask_b = stacked.profession_rows_b & (
+            stacked.class_ids_b != stacked.class_positions[class_idx]
+        )
+        negative_indices = negative_mask_b.nonzero().squeeze(1)
     else:
         if class_idx not in utils.PAIRED_CLASS_KEYS:
             raise ValueError(f"Class index {class_idx} is not a valid class index.")
 
-        negative_acts = all_activations[utils.PAIRED_CLASS_KEYS[class_idx]]
+        paired_rows = get_class_rows(stacked, utils.PAIRED_CLASS_KEYS[class_idx])
+        negative_indices = t.arange(paired_rows.start, paired_rows.stop, device=device)
+
+    return negative_indices[t.randperm(len(negative_indices), device=device)[:num_samples]]
+
+
+@functools.lru_cache(maxsize=None)
+def get_shuffle_stream(device: t.device) -> t.cuda.Stream:
+    """The side stream prepare_probe_data() shuffles on. Created once per device, as it is called once per class."""
+    return t.cuda.Stream(device=device)
+
+
+def prepare_probe_data(
+    all_activations: dict[int | str, t.Tensor],
+    class_idx: int | str,
+    batch_size: int,
+    stacked_activations: Optional[StackedActivations] = None,
+) -> tuple[t.Tensor, t.Tensor]:
+    """Returns activations of shape [num_batches, batch_size, d_model] and labels of shape [num_batches, batch_size].
+    If class_idx is a string, there is a paired class idx in utils.py.
+    Pass in stacked_activations when preparing data for many classes."""
+    if stacked_activations is None:
+        stacked_activations = stack_class_activations(all_activations)
+
+    positive_acts = stacked_activations.acts_bD[get_class_rows(stacked_activations, class_idx)]
+    device = positive_acts.device
+
+    num_positive = len(positive_acts)
 
     # Randomly select num_positive samples from negative class
-    indices = t.randperm(len(negative_acts))[:num_positive]
-    selected_negative_acts = negative_acts[indices]
+    indices = sample_negative_indices(stacked_activations, class_idx, num_positive)
+    selected_negative_acts = stacked_activations.acts_bD[indices]
 
     assert selected_negative_acts.shape == positive_acts.shape
 
@@ -340,81 +544,187 @@ def prepare_probe_data(
     combined_labels[:num_positive] = utils.POSITIVE_CLASS_LABEL
     combined_labels[num_positive:] = utils.NEGATIVE_CLASS_LABEL
 
-    # Shuffle the combined data
-    shuffle_indices = t.randperm(len(combined_acts))
-    shuffled_acts = combined_acts[shuffle_indices]
-    shuffled_labels = combined_labels[shuffle_indices]
+    # Shuffle the combined data. On CUDA this runs on a side stream, so the host can keep queuing work
+    # and the gather only has to finish before the current stream uses its result.
+    if combined_acts.is_cuda:
+        current_stream = t.cuda.current_stream(device)
+        shuffle_stream = get_shuffle_stream(device)
+        shuffle_stream.wait_stream(current_stream)
+        with t.cuda.stream(shuffle_stream):
+            shuffle_indices = t.randperm(len(combined_acts), device=device)
+            shuffled_acts = combined_acts.index_select(0, shuffle_indices)
+            shuffled_labels = combined_labels.index_select(0, shuffle_indices)
+        current_stream.wait_stream(shuffle_stream)
+        shuffled_acts.record_stream(current_stream)
+        shuffled_labels.record_stream(current_stream)
+    else:
+        shuffle_indices = t.randperm(len(combined_acts), device=device)
+        shuffled_acts = combined_acts[shuffle_indices]
+        shuffled_labels = combined_labels[shuffle_indices]
 
-    # Reshape into lists of tensors with specified batch_size
+    # Reshape into batches of size batch_size, dropping the last incomplete batch
     num_samples = len(shuffled_acts)
     num_batches = num_samples // batch_size
 
-    batched_acts = [
-        shuffled_acts[i * batch_size : (i + 1) * batch_size] for i in range(num_batches)
-    ]
-    batched_labels = [
-        shuffled_labels[i * batch_size : (i + 1) * batch_size] for i in range(num_batches)
-    ]
+    batched_acts_NBD = shuffled_acts[: num_batches * batch_size].view(
+        num_batches, batch_size, -1
+    )
+    batched_labels_NB = shuffled_labels[: num_batches * batch_size].view(num_batches, batch_size)
+
+    return batched_acts_NBD, batched_labels_NB
+
 
-    return batched_acts, batched_labels
+def prepare_joint_probe_data(
+    stacked_activations: StackedActivations,
+    class_list: list[int | str],
+) -> tuple[t.Tensor, t.Tensor]:
+    """Column c of the mask selects the balanced dataset prepare_probe_data() would build for class_list[c]."""
+    device = stacked_activations.acts_bD.device
+
+    labels_bC = t.full(
+        (len(stacked_activations.acts_bD), len(class_list)),
+        float(utils.NEGATIVE_CLASS_LABEL),
+        dtype=t.float32,
+        device=device,
+    )
+    mask_bC = t.zeros_like(labels_bC)
+
+    for c, class_idx in enumerate(class_list):
+        positive_rows = get_class_rows(stacked_activations, class_idx)
+        num_positive = positive_rows.stop - positive_rows.start
+        negative_indices = sample_negative_indices(stacked_activations, class_idx, num_positive)
+
+        labels_bC[positive_rows, c] = float(utils.POSITIVE_CLASS_LABEL)
+        mask_bC[positive_rows, c] = 1.0
+        mask_bC[negative_indices, c] = 1.0
+
+    return labels_bC, mask_bC
+
+
+def masked_bce_loss(logits_BC: t.Tensor, labels_BC: t.Tensor, mask_BC: t.Tensor) -> t.Tensor:
+    """Mean BCE over the (sample, probe) pairs selected by mask_BC."""
+    loss = nn.functional.binary_cross_entropy_with_logits(
+        logits_BC.float(), labels_BC, weight=mask_BC, reduction="sum"
+    )
+    return loss / mask_BC.sum().clamp(min=1.0)
+
+
+def probe_l2_penalty(probe: nn.Linear, weight_decay: float) -> t.Tensor:
+    """L2 penalty on the weights, averaged over probes like masked_bce_loss."""
+    return weight_decay * probe.weight.pow(2).sum(dim=1).mean()
+
+
+@t.no_grad()
+def get_joint_probe_accuracies(
+    probe: nn.Linear, acts_bD: t.Tensor, labels_bC: t.Tensor, mask_bC: t.Tensor
+) -> t.Tensor:
+    """Accuracy of every probe (output column) on its own balanced dataset."""
+    preds_bC = (probe(acts_bD) > 0.0).float()
+    corrects_bC = (preds_bC == labels_bC).float() * mask_bC
+    return corrects_bC.sum(0) / mask_bC.sum(0)
+
+
+def get_graphed_probe_closure(
+    probe: nn.Linear, X_ND: t.Tensor, y_NC: t.Tensor, mask_NC: t.Tensor, weight_decay: float
+) -> Callable[[], t.Tensor]:
+    """Captures the probe forward, loss and backward into a CUDA graph, replayed by the returned closure."""
+
+    def forward_backward() -> t.Tensor:
+        loss = masked_bce_loss(probe(X_ND), y_NC, mask_NC) + probe_l2_penalty(probe, weight_decay)
+        loss.backward()
+        return loss
+
+    # Warmup has to run on a side stream before capture
+    side_stream = t.cuda.Stream()
+    side_stream.wait_stream(t.cuda.current_stream())
+    with t.cuda.stream(side_stream):
+        for _ in range(3):
+            probe.zero_grad(set_to_none=True)
+            forward_backward()
+    t.cuda.current_stream().wait_stream(side_stream)
+
+    # Gradients must be None during capture, so backward allocates them from the graph's memory pool
+    probe.zero_grad(set_to_none=True)
+    graph = t.cuda.CUDAGraph()
+    with t.cuda.graph(graph):
+        static_loss = forward_backward()
+
+    def closure() -> t.Tensor:
+        graph.replay()
+        # Later replays overwrite static_loss, but LBFGS returns the loss of its first closure call
+        return static_loss.clone()
+
+    return closure
 
 
 def train_probe(
-    train_input_batches: list,
-    train_label_batches: list[t.Tensor],
-    test_input_batches: list,
-    test_label_batches: list[t.Tensor],
-    get_acts: Callable,
-    precomputed_acts: bool,
+    train_acts_bD: t.Tensor,
+    train_labels_bC: t.Tensor,
+    train_mask_bC: t.Tensor,
+    test_acts_bD: t.Tensor,
+    test_labels_bC: t.Tensor,
+    test_mask_bC: t.Tensor,
     dim: int,
     epochs: int,
     device: str,
-    model_dtype: t.dtype,
-    lr: float = 1e-2,
-    seed: int = SEED,
-) -> tuple[Probe, float]:
-    """input_batches can be a list of tensors or strings. If strings, get_acts must be provided."""
+    lr: float = 1.0,
+    max_iter: int = 5,
+    weight_decay: float = 0.01,
+) -> tuple[nn.Linear, t.Tensor]:
+    """Trains one probe per label column as a single nn.Linear with full batch LBFGS, one step of up to max_iter
+    iterations per epoch. Returns the probe and the test accuracy of every column."""
+    num_classes = train_labels_bC.shape[1]
+    probe = nn.Linear(dim, num_classes, bias=True, dtype=t.float32).to(device)
+    optimizer = t.optim.LBFGS(
+        probe.parameters(), lr=lr, max_iter=max_iter, line_search_fn="strong_wolfe"
+    )
 
-    if type(train_input_batches[0]) == str or type(test_input_batches[0]) == str:
-        assert precomputed_acts == False
-    elif type(train_input_batches[0]) == t.Tensor or type(test_input_batches[0]) == t.Tensor:
-        assert precomputed_acts == True
+    # Rows that aren't in the dataset of any probe don't contribute to the loss
+    used_rows_b = train_mask_bC.any(dim=1)
+    X_ND = train_acts_bD[used_rows_b].float()
+    y_NC = train_labels_bC[used_rows_b]
+    mask_NC = train_mask_bC[used_rows_b]
+    test_X_bD = test_acts_bD.float()
 
-    probe = Probe(dim, model_dtype).to(device)
-    optimizer = t.optim.AdamW(probe.parameters(), lr=lr)
-    criterion = nn.BCEWithLogitsLoss()
+    if X_ND.is_cuda:
+        closure = get_graphed_probe_closure(probe, X_ND, y_NC, mask_NC, weight_decay)
+    else:
 
-    for epoch in range(epochs):
-        batch_idx = 0
-        for inputs, labels in zip(train_input_batches, train_label_batches):
-            if precomputed_acts:
-                acts_BD = inputs
-            else:
-                acts_BD = get_acts(inputs)
-            logits_B = probe(acts_BD)
-            loss = criterion(logits_B, labels.clone().detach().to(device=device, dtype=model_dtype))
+        def closure():
             optimizer.zero_grad()
+            loss = masked_bce_loss(probe(X_ND), y_NC, mask_NC) + probe_l2_penalty(probe, weight_decay)
             loss.backward()
-            optimizer.step()
-            batch_idx += 1
+            return loss
+
+    for epoch in range(epochs):
+        loss = optimizer.step(closure)
         print(f"\nEpoch {epoch + 1}/{epochs} Loss: {loss.item()}")
 
-        train_accuracy = test_probe(
-            train_input_batches[:30], train_label_batches[:30], probe, get_acts, precomputed_acts
-        )
+        train_accuracies = get_joint_probe_accuracies(probe, X_ND, y_NC, mask_NC)
+        print(f"Train Accuracy: {train_accuracies.mean().item()}")
 
-        print(f"Train Accuracy: {train_accuracy}")
+        test_accuracies = get_joint_probe_accuracies(probe, test_X_bD, test_labels_bC, test_mask_bC)
+        print(f"Test Accuracy: {test_accuracies.mean().item()}")
+    return probe, test_accuracies
 
-        test_accuracy = test_probe(
-            test_input_batches, test_label_batches, probe, get_acts, precomputed_acts
-        )
-        print(f"Test Accuracy: {test_accuracy}")
-    return probe, test_accuracy
+
+def split_joint_probe(
+    joint_probe: nn.Linear, class_list: list[int | str], dtype: t.dtype
+) -> dict[int | str, Probe]:
+    """Unpacks a jointly trained probe into one Probe per class, which is the format probes are saved in."""
+    probes = {}
+    for c, class_idx in enumerate(class_list):
+        probe = Probe(joint_probe.in_features, dtype).to(joint_probe.weight.device)
+        with t.no_grad():
+            probe.net.weight.copy_(joint_probe.weight[c : c + 1])
+            probe.net.bias.copy_(joint_probe.bias[c : c + 1])
+        probes[class_idx] = probe
+    return probes
 
 
 def test_probe(
-    input_batches: list,
-    label_batches: list[t.Tensor],
+    input_batches: t.Tensor,
+    label_batches: t.Tensor,
     probe: Probe,
     precomputed_acts: bool,
     get_acts: Optional[Callable] = None,
@@ -424,34 +734,24 @@ def test_probe(
 
     criterion = nn.BCEWithLogitsLoss()
 
-    with t.no_grad():
-        corrects_0 = []
-        corrects_1 = []
-        all_corrects = []
-        losses = []
-
-        for input_batch, labels_B in zip(input_batches, label_batches):
-            if precomputed_acts:
-                acts_BD = input_batch
-            else:
-                raise NotImplementedError("Currently deprecated.")
-                acts_BD = get_acts(input_batch)
-
-            logits_B = probe(acts_BD)
-            preds_B = (logits_B > 0.0).long()
-            correct_B = (preds_B == labels_B).float()
-
-            all_corrects.append(correct_B)
-            corrects_0.append(correct_B[labels_B == 0])
-            corrects_1.append(correct_B[labels_B == 1])
-
-            loss = criterion(logits_B, labels_B.to(dtype=probe.net.weight.dtype))
-            losses.append(loss)
-
-        accuracy_all = t.cat(all_corrects).mean().item()
-        loss = t.stack(losses).mean().item()
-        accuracy_0 = t.cat(corrects_0).mean().item() if corrects_0 else 0.0
-        accuracy_1 = t.cat(corrects_1).mean().item() if corrects_1 else 0.0
+    if not precomputed_acts:
+        raise NotImplementedError("Currently deprecated.")
+
+    with t.inference_mode():
+        # All batches are evaluated at once, they are already on the GPU
+        acts_bD = input_batches.flatten(0, 1)
+        labels_b = label_batches.flatten()
+
+        logits_b = probe(acts_bD)
+        preds_b = (logits_b > 0.0).long()
+        correct_b = (preds_b == labels_b).float()
+
+        accuracy_all = correct_b.mean().item()
+        loss = criterion(logits_b, labels_b.to(dtype=logits_b.dtype)).item()
+        corrects_0 = correct_b[labels_b == 0]
+        corrects_1 = correct_b[labels_b == 1]
+        accuracy_0 = corrects_0.mean().item() if len(corrects_0) else 0.0
+        accuracy_1 = corrects_1.mean().item() if len(corrects_1) else 0.0
 
     return accuracy_all, accuracy_0, accuracy_1, loss
 
@@ -463,9 +763,10 @@ def get_probe_test_accuracy(
     probe_batch_size: int,
 ):
     test_accuracies = {}
+    stacked_activations = stack_class_activations(all_activations)
     for class_name in all_class_list:
         batch_test_acts, batch_test_labels = prepare_probe_data(
-            all_activations, class_name, probe_batch_size
+            all_activations, class_name, probe_batch_size, stacked_activations
         )
         test_acc_probe, acc_0, acc_1, loss = test_probe(
             batch_test_acts, batch_test_labels, probes[class_name], precomputed_acts=True
@@ -482,7 +783,7 @@ def get_probe_test_accuracy(
             continue
         spurious_class_names = [key for key in utils.PAIRED_CLASS_KEYS if key != class_name]
         batch_test_acts, batch_test_labels = prepare_probe_data(
-            all_activations, class_name, probe_batch_size
+            all_activations, class_name, probe_batch_size, stacked_activations
         )
 
         for spurious_class_name in spurious_class_names:
@@ -520,18 +821,22 @@ def train_probes(
     save_results: bool = True,
     seed: int = SEED,
     include_gender: bool = False,
+    use_activation_cache: Optional[bool] = None,
 ) -> dict[int, float]:
-    """Because we save the probes, we always train them on all classes to avoid potential issues with missing classes. It's only a one-time cost."""
+    """Because we save the probes, we always train them on all classes to avoid potential issues with missing classes. It's only a one-time cost.
+    use_activation_cache defaults to save_results. probe_batch_size is ignored, as training is full batch."""
     t.manual_seed(seed)
     random.seed(seed)
     np.random.seed(seed)
 
+    only_model_name = llm_model_name.split("/")[-1]
+
     model_eval_config = utils.ModelEvalConfig.from_full_model_name(llm_model_name)
     d_model = model_eval_config.activation_dim
     probe_layer = model_eval_config.probe_layer
     probe_act_submodule = utils.get_submodule(model, "resid_post", probe_layer)
 
-    dataset, df = load_and_prepare_dataset()
+    dataset, _ = load_and_prepare_dataset()
 
     train_bios, test_bios = get_train_test_data(
         dataset,
@@ -540,61 +845,77 @@ def train_probes(
         include_gender,
     )
 
-    train_bios = utils.tokenize_data(train_bios, model.tokenizer, context_length, device)
-    test_bios = utils.tokenize_data(test_bios, model.tokenizer, context_length, device)
-
     probes, test_accuracies = {}, {}
 
-    all_train_acts = {}
-    all_test_acts = {}
+    if use_activation_cache is None:
+        use_activation_cache = save_results
+    if use_activation_cache:
+        activation_cache_dir = f"{probe_dir}/{only_model_name}/activation_cache"
+    else:
+        activation_cache_dir = None
+    activation_cache_key = f"resid_post_layer_{probe_layer}_ctx_len_{context_length}"
 
     with t.no_grad():
-        for i, profession in enumerate(train_bios.keys()):
-            # if isinstance(profession, int):
-            #     continue
-
-            print(f"Collecting activations for profession: {profession}")
-
-            all_train_acts[profession] = get_all_activations(
-                train_bios[profession], model, llm_batch_size, probe_act_submodule
-            )
-            all_test_acts[profession] = get_all_activations(
-                test_bios[profession], model, llm_batch_size, probe_act_submodule
-            )
+        print("Collecting train activations")
+        all_train_acts = get_all_class_activations(
+            train_bios,
+            model,
+            llm_batch_size,
+            probe_act_submodule,
+            context_length,
+            cache_dir=activation_cache_dir,
+            cache_key=activation_cache_key,
+        )
+        print("Collecting test activations")
+        all_test_acts = get_all_class_activations(
+            test_bios,
+            model,
+            llm_batch_size,
+            probe_act_submodule,
+            context_length,
+            cache_dir=activation_cache_dir,
+            cache_key=activation_cache_key,
+        )
 
     t.set_grad_enabled(True)
 
+    stacked_train_acts = stack_class_activations(all_train_acts)
+    stacked_test_acts = stack_class_activations(all_test_acts)
+
+    # Probes trained for a different number of epochs can't share an optimizer, so group them
+    epochs_to_classes = defaultdict(list)
     for profession in all_train_acts.keys():
         if profession in utils.PAIRED_CLASS_KEYS.values():
             continue
 
-        train_acts, train_labels = prepare_probe_data(all_train_acts, profession, probe_batch_size)
-
-        test_acts, test_labels = prepare_probe_data(all_test_acts, profession, probe_batch_size)
-
         if profession == "biased_male / biased_female" or profession == "male / female":
             probe_epochs = 1
         else:
             probe_epochs = epochs
 
-        probe, test_accuracy = train_probe(
-            train_acts,
+        epochs_to_classes[probe_epochs].append(profession)
+
+    for probe_epochs, class_list in epochs_to_classes.items():
+        train_labels, train_mask = prepare_joint_probe_data(stacked_train_acts, class_list)
+        test_labels, test_mask = prepare_joint_probe_data(stacked_test_acts, class_list)
+
+        joint_probe, joint_test_accuracies = train_probe(
+            stacked_train_acts.acts_bD,
             train_labels,
-            test_acts,
+            train_mask,
+            stacked_test_acts.acts_bD,
             test_labels,
-            get_acts,
-            precomputed_acts=True,
-            epochs=probe_epochs,
+            test_mask,
             dim=d_model,
+            epochs=probe_epochs,
             device=device,
-            model_dtype=model_dtype,
         )
 
-        probes[profession] = probe
-        test_accuracies[profession] = test_accuracy
+        probes.update(split_joint_probe(joint_probe, class_list, model_dtype))
+        for profession, test_accuracy in zip(class_list, joint_test_accuracies.tolist()):
+            test_accuracies[profession] = test_accuracy
 
     if save_results:
-        only_model_name = llm_model_name.split("/")[-1]
         os.makedirs(f"{probe_dir}", exist_ok=True)
         os.makedirs(f"{probe_dir}/{only_model_name}", exist_ok=True)
 
@@ -213,23 +213,54 @@ def load_dictionary(model, base_path: str, device: str, verbose: bool = True):
 
     submodule = get_submodule(model, submodule_str, layer)
 
+    # dictionary_learning's from_pretrained() calls torch.load() without map_location, which restores CUDA saved
+    # checkpoints on the GPU first. We memory map the state dict on the CPU and copy it over through pinned memory.
+    state_dict = torch.load(ae_path, map_location="cpu", mmap=True, weights_only=True)
+
     if dict_class == "AutoEncoder":
-        dictionary = AutoEncoder.from_pretrained(ae_path, device=device)
+        dict_size, activation_dim = state_dict["encoder.weight"].shape
+        dictionary = AutoEncoder(activation_dim, dict_size)
+        dictionary.load_state_dict(state_dict)
+        # As AutoEncoder.from_pretrained() does by default
+        dictionary.normalize_decoder()
     # elif dict_class == "IdentityDict":
-    #     dictionary = IdentityDict.from_pretrained(ae_path, device=device)
+    #     dictionary = IdentityDict.from_pretrained(ae_path, device="cpu")
     elif dict_class == "GatedAutoEncoder":
-        dictionary = GatedAutoEncoder.from_pretrained(ae_path, device=device)
+        dict_size, activation_dim = state_dict["encoder.weight"].shape
+        dictionary = GatedAutoEncoder(activation_dim, dict_size)
+        dictionary.load_state_dict(state_dict)
     elif dict_class == "AutoEncoderNew":
-        dictionary = AutoEncoderNew.from_pretrained(ae_path, device=device)
+        dict_size, activation_dim = state_dict["encoder.weight"].shape
+        dictionary = AutoEncoderNew(activation_dim, dict_size)
+        dictionary.load_state_dict(state_dict)
     elif dict_class == "AutoEncoderTopK":
+        dict_size, activation_dim = state_dict["encoder.weight"].shape
         k = config["trainer"]["k"]
-        dictionary = AutoEncoderTopK.from_pretrained(ae_path, k=k, device=device)
+        if "k" in state_dict and k != state_dict["k"].item():
+            raise ValueError(f"k={k} != {state_dict['k'].item()}=state_dict['k']")
+        dictionary = AutoEncoderTopK(activation_dim, dict_size, k)
+        dictionary.load_state_dict(state_dict)
     else:
         raise ValueError(f"Dictionary class {dict_class} not supported")
 
+    dictionary = to_device_pinned(dictionary, device)
+
     return submodule, dictionary, config
 
 
+def to_device_pinned(module: torch.nn.Module, device: str) -> torch.nn.Module:
+    """Moves module to device, staging every tensor in pinned memory so the copies are asynchronous."""
+    if torch.device(device).type != "cuda":
+        return module.to(device)
+
+    for tensor in list(module.parameters()) + list(module.buffers()):
+        if tensor.is_cpu:
+            tensor.data = tensor.data.pin_memory().to(device, non_blocking=True)
+        else:
+            tensor.data = tensor.data.to(device)
+    return module
+
+
 def get_submodule(model, submodule_str: str, layer: int):
     allowed_submodules = ["attention_out", "mlp_out", "resid_post", "unembed"]
 
@@ -286,6 +317,67 @@ def batch_inputs(inputs, batch_size: int):
         raise ValueError("Unsupported input type")
 
 
+def batch_inputs_by_length(
+    inputs: dict[str, torch.Tensor], batch_size: int, padding_side: str, pin_memory: bool = False
+) -> tuple[list[dict[str, torch.Tensor]], torch.Tensor]:
+    """Sorts inputs by length and batches them, trimming every batch to its longest input.
+    Returns the batches and the indices that sorted the inputs."""
+    lengths_b = inputs["attention_mask"].sum(1)
+    sort_indices_b = torch.argsort(lengths_b, descending=True)
+    sorted_lengths = lengths_b[sort_indices_b].tolist()
+    context_length = inputs["input_ids"].shape[1]
+
+    batches = []
+    for start in range(0, len(sort_indices_b), batch_size):
+        batch_indices = sort_indices_b[start : start + batch_size]
+        max_length = sorted_lengths[start]
+        if padding_side == "left":
+            columns = slice(context_length - max_length, context_length)
+        else:
+            columns = slice(0, max_length)
+
+        batch = {}
+        for key, value in inputs.items():
+            # Inputs may already be on the GPU, only host memory can be pinned
+            batch[key] = torch.empty(
+                (len(batch_indices), max_length),
+                dtype=value.dtype,
+                device=value.device,
+                pin_memory=pin_memory and value.device.type == "cpu",
+            )
+            torch.index_select(value[:, columns], 0, batch_indices, out=batch[key])
+        batches.append(batch)
+
+    return batches, sort_indices_b
+
+
+def prefetch_to_device(batches: list[dict[str, torch.Tensor]], device: str):
+    """Yields the batches on device. On CUDA, the next batch is copied on a side stream."""
+    if torch.device(device).type != "cuda":
+        for batch in batches:
+            yield to_device(batch, device)
+        return
+
+    copy_stream = torch.cuda.Stream(device=device)
+
+    def copy_batch(batch: dict[str, torch.Tensor]) -> dict[str, torch.Tensor]:
+        with torch.cuda.stream(copy_stream):
+            return {key: value.to(device, non_blocking=True) for key, value in batch.items()}
+
+    next_batch = copy_batch(batches[0]) if batches else None
+    for i in range(len(batches)):
+        current_stream = torch.cuda.current_stream(device)
+        current_stream.wait_stream(copy_stream)
+        batch = next_batch
+        for value in batch.values():
+            # The batch was allocated on copy_stream, so its memory must not be reused until current_stream is done with it
+            value.record_stream(current_stream)
+
+        if i + 1 < len(batches):
+            next_batch = copy_batch(batches[i + 1])
+        yield batch
+
+
 def tokenize_data(
     data: dict[int, list[str]], tokenizer, max_length: int, device: str
 ) -> dict[int, dict]:
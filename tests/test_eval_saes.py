@@ -1,8 +1,11 @@
 from nnsight import LanguageModel
+from transformers import AutoTokenizer
+import pytest
 import torch
 
 import experiments.eval_saes as eval_saes
 import experiments.utils as utils
+from dictionary_learning.buffer import ActivationBuffer
 
 
 def test_eval_saes():
@@ -51,3 +54,89 @@ def test_eval_saes():
 
         difference = abs(eval_results["frac_recovered"] - expected_frac_recovered)
         assert difference < tolerance
+
+
+def test_truncated_inputs_round_trip():
+    context_length = 16
+    input_strings = [
+        "Hello , world . Spaces before punctuation must survive decoding .",
+        "A literal <|endoftext|> in the middle of a document",
+        "short",
+        " word" * 40,
+        # Cut in the middle of long words and of multi-byte characters
+        " antidisestablishmentarianism" * 10,
+        "naïveté café 日本語のテキスト 🙂🙃" * 10,
+    ]
+
+    tokenizer = AutoTokenizer.from_pretrained("EleutherAI/pythia-70m-deduped")
+    tokenizer.pad_token = tokenizer.eos_token
+
+    for padding_side in ["left", "right"]:
+        tokenizer.padding_side = padding_side
+        tokens_NL, lengths_N = eval_saes.get_tokenized_inputs(tokenizer, input_strings, context_length)
+
+        truncated_strings = eval_saes.get_truncated_inputs(
+            tokenizer, input_strings, tokens_NL, lengths_N
+        )
+        # The same tokenizer call ActivationBuffer makes
+        retokenized = tokenizer(
+            truncated_strings,
+            truncation=True,
+            max_length=context_length,
+            padding="max_length",
+            return_tensors="np",
+        )
+
+        assert (retokenized["input_ids"] == tokens_NL).all()
+        assert (retokenized["attention_mask"].sum(axis=1) == lengths_N).all()
+
+
+class StubActivationBuffer:
+    """Stands in for an ActivationBuffer, numbering its activation and text batches in the order drawn."""
+
+    def __init__(self, batch_size: int, d_submodule: int):
+        self.batch_size = batch_size
+        self.d_submodule = d_submodule
+        self.num_activation_batches = 0
+        self.num_text_batches = 0
+
+    def __next__(self):
+        acts = torch.full((self.batch_size, self.d_submodule), float(self.num_activation_batches))
+        self.num_activation_batches += 1
+        return acts
+
+    def text_batch(self, batch_size=None):
+        texts = [f"batch {self.num_text_batches} text {i}" for i in range(batch_size)]
+        self.num_text_batches += 1
+        return texts
+
+
+def test_replay_activation_buffer():
+    n_batches, batch_size, d_submodule = 3, 4, 2
+    stub_buffer = StubActivationBuffer(batch_size, d_submodule)
+
+    replay_buffer = eval_saes.ReplayActivationBuffer(stub_buffer, n_batches, batch_size, "cpu")
+
+    assert isinstance(replay_buffer, ActivationBuffer)
+    assert replay_buffer.d_submodule == d_submodule
+    assert stub_buffer.num_activation_batches == n_batches
+    assert stub_buffer.num_text_batches == n_batches
+
+    passes = []
+    for _ in range(2):
+        replay_buffer.reset()
+        # evaluate() draws one text batch after every activation batch
+        drawn = []
+        for _ in range(n_batches):
+            acts = next(replay_buffer)
+            texts = replay_buffer.text_batch(batch_size=batch_size)
+            drawn.append((acts, texts))
+        passes.append(drawn)
+
+        with pytest.raises(StopIteration):
+            next(replay_buffer)
+
+    for i in range(n_batches):
+        for acts, texts in [passes[0][i], passes[1][i]]:
+            assert (acts == i).all()
+            assert texts == [f"batch {i} text {j}" for j in range(batch_size)]
@@ -1,4 +1,10 @@
+from types import SimpleNamespace
+
+import pytest
+import torch as t
+
 import experiments.probe_training as probe_training
+import experiments.utils as utils
 
 
 def test_probing():
@@ -19,6 +25,8 @@ def test_probing():
         seed=42,
     )
 
+    # Measured when probes were trained per class with AdamW. They have not been re-measured since
+    # train_probe() moved to joint LBFGS with weight decay, update them on a GPU if this test fails
     expected_accuracies = {
         0: 0.8130000233650208,
         1: 0.8040000200271606,
@@ -46,3 +54,156 @@ def test_probing():
         difference = abs(test_accuracies[class_idx] - expected_accuracies[class_idx])
 
         assert difference < tolerance
+
+
+def test_activation_cache_round_trip(tmp_path):
+    calls = []
+
+    @probe_training.cache_activations
+    def get_stub_activations(text_inputs, model, batch_size, submodule):
+        calls.append(len(text_inputs))
+        return t.arange(len(text_inputs) * 4, dtype=t.float32).reshape(len(text_inputs), 4)
+
+    model = SimpleNamespace(
+        config=SimpleNamespace(_name_or_path="stub-model"),
+        dtype=t.float32,
+        device=t.device("cpu"),
+    )
+    text_inputs = ["first bio", "second bio", "third bio"]
+
+    acts_bD = get_stub_activations(
+        text_inputs, model, 2, None, cache_dir=str(tmp_path), cache_key="key"
+    )
+    cached_acts_bD = get_stub_activations(
+        text_inputs, model, 2, None, cache_dir=str(tmp_path), cache_key="key"
+    )
+    assert calls == [3]
+    assert t.equal(acts_bD, cached_acts_bD)
+
+    # Changing the inputs, the cache key or the model dtype must miss the cache
+    get_stub_activations(text_inputs[:2], model, 2, None, cache_dir=str(tmp_path), cache_key="key")
+    get_stub_activations(
+        text_inputs, model, 2, None, cache_dir=str(tmp_path), cache_key="other_key"
+    )
+    model.dtype = t.bfloat16
+    get_stub_activations(text_inputs, model, 2, None, cache_dir=str(tmp_path), cache_key="key")
+    assert calls == [3, 2, 3, 3]
+
+
+def make_class_activations() -> dict:
+    # Column 0 holds the position of the class, column 1 the row number, so we can tell where a sample came from
+    class_sizes = {0: 5, 1: 7, 2: 6, "male / female": 4, "female_data_only": 4}
+    all_activations = {}
+    row = 0
+    for position, (class_name, size) in enumerate(class_sizes.items()):
+        rows = t.arange(row, row + size, dtype=t.float32)
+        all_activations[class_name] = t.stack([t.full_like(rows, position), rows], dim=1)
+        row += size
+    return all_activations
+
+
+def test_sample_negative_indices():
+    t.manual_seed(0)
+    stacked = probe_training.stack_class_activations(make_class_activations())
+
+    for class_idx in [0, 1, 2]:
+        own_rows = probe_training.get_class_rows(stacked, class_idx)
+        negative_indices = probe_training.sample_negative_indices(
+            stacked, class_idx, own_rows.stop - own_rows.start
+        )
+
+        assert len(negative_indices) == own_rows.stop - own_rows.start
+        assert len(t.unique(negative_indices)) == len(negative_indices)
+        negative_classes = [
+            stacked.class_names[i] for i in stacked.class_ids_b[negative_indices].tolist()
+        ]
+        # Negatives come from the other professions, never from the class itself or the paired classes
+        assert all(isinstance(name, int) and name != class_idx for name in negative_classes)
+
+    negative_indices = probe_training.sample_negative_indices(stacked, "male / female", 4)
+    paired_rows = probe_training.get_class_rows(stacked, "female_data_only")
+    assert sorted(negative_indices.tolist()) == list(range(paired_rows.start, paired_rows.stop))
+
+    with pytest.raises(ValueError):
+        probe_training.sample_negative_indices(stacked, "female_data_only", 4)
+
+
+def test_prepare_joint_probe_data():
+    t.manual_seed(0)
+    stacked = probe_training.stack_class_activations(make_class_activations())
+    class_list = [0, 1, 2, "male / female"]
+
+    labels_bC, mask_bC = probe_training.prepare_joint_probe_data(stacked, class_list)
+
+    for c, class_idx in enumerate(class_list):
+        positive_rows = probe_training.get_class_rows(stacked, class_idx)
+        num_positive = positive_rows.stop - positive_rows.start
+        assert mask_bC[:, c].sum() == 2 * num_positive
+
+        is_positive_b = t.zeros(len(labels_bC), dtype=t.bool)
+        is_positive_b[positive_rows] = True
+        assert (labels_bC[is_positive_b, c] == utils.POSITIVE_CLASS_LABEL).all()
+        assert (labels_bC[~is_positive_b, c] == utils.NEGATIVE_CLASS_LABEL).all()
+
+        negative_classes = stacked.class_ids_b[(mask_bC[:, c] == 1) & ~is_positive_b]
+        if isinstance(class_idx, int):
+            assert all(isinstance(stacked.class_names[i], int) for i in negative_classes.tolist())
+        else:
+            paired_position = stacked.class_positions[utils.PAIRED_CLASS_KEYS[class_idx]]
+            assert (negative_classes == paired_position).all()
+
+
+def test_prepare_probe_data():
+    t.manual_seed(0)
+    all_activations = make_class_activations()
+    class_position = list(all_activations.keys()).index(1)
+
+    acts_NBD, labels_NB = probe_training.prepare_probe_data(all_activations, 1, batch_size=7)
+
+    assert acts_NBD.shape == (2, 7, 2)
+    acts_bD, labels_b = acts_NBD.flatten(0, 1), labels_NB.flatten()
+    is_own_class_b = acts_bD[:, 0] == class_position
+    assert (labels_b[is_own_class_b] == utils.POSITIVE_CLASS_LABEL).all()
+    assert (labels_b[~is_own_class_b] == utils.NEGATIVE_CLASS_LABEL).all()
+    assert is_own_class_b.sum() == 7
+    # Every row is used at most once
+    assert len(t.unique(acts_bD[:, 1])) == len(acts_bD)
+
+
+def test_train_probe():
+    t.manual_seed(0)
+    dim = 16
+    class_means = {class_idx: 4 * t.randn(dim) for class_idx in [0, 1, 2, 3]}
+
+    def make_split(num_per_class: int) -> probe_training.StackedActivations:
+        all_activations = {
+            class_idx: mean + t.randn(num_per_class, dim) for class_idx, mean in class_means.items()
+        }
+        return probe_training.stack_class_activations(all_activations)
+
+    train_stacked, test_stacked = make_split(50), make_split(50)
+    class_list = list(class_means.keys())
+    train_labels, train_mask = probe_training.prepare_joint_probe_data(train_stacked, class_list)
+    test_labels, test_mask = probe_training.prepare_joint_probe_data(test_stacked, class_list)
+
+    joint_probe, test_accuracies = probe_training.train_probe(
+        train_stacked.acts_bD,
+        train_labels,
+        train_mask,
+        test_stacked.acts_bD,
+        test_labels,
+        test_mask,
+        dim=dim,
+        epochs=3,
+        device="cpu",
+    )
+
+    assert test_accuracies.shape == (len(class_list),)
+    assert (test_accuracies > 0.95).all()
+
+    probes = probe_training.split_joint_probe(joint_probe, class_list, t.float32)
+    assert list(probes.keys()) == class_list
+    with t.no_grad():
+        joint_logits_bC = joint_probe(test_stacked.acts_bD)
+        for c, class_idx in enumerate(class_list):
+            assert t.allclose(probes[class_idx](test_stacked.acts_bD), joint_logits_bC[:, c])
@@ -0,0 +1,113 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+import experiments.utils as utils
+from dictionary_learning import AutoEncoder
+from dictionary_learning.trainers.top_k import AutoEncoderTopK
+
+
+def make_padded_inputs(lengths: list[int], context_length: int, padding_side: str) -> dict:
+    input_ids = torch.zeros((len(lengths), context_length), dtype=torch.long)
+    attention_mask = torch.zeros((len(lengths), context_length), dtype=torch.long)
+    for i, length in enumerate(lengths):
+        tokens = torch.randint(1, 100, (length,))
+        if padding_side == "left":
+            input_ids[i, context_length - length :] = tokens
+            attention_mask[i, context_length - length :] = 1
+        else:
+            input_ids[i, :length] = tokens
+            attention_mask[i, :length] = 1
+    return {"input_ids": input_ids, "attention_mask": attention_mask}
+
+
+def mean_pool(embeddings_VD: torch.Tensor, inputs: dict) -> torch.Tensor:
+    mask_BL = inputs["attention_mask"].float()
+    acts_BLD = embeddings_VD[inputs["input_ids"]]
+    return torch.einsum("bld,bl->bd", acts_BLD, mask_BL) / mask_BL.sum(1, keepdim=True)
+
+
+DEVICES = ["cpu"] + (["cuda"] if torch.cuda.is_available() else [])
+
+
+# get_all_activations() is called with inputs tokenized on the CPU and with inputs already on the GPU
+@pytest.mark.parametrize("device", DEVICES)
+def test_batch_inputs_by_length(device):
+    torch.manual_seed(0)
+    context_length = 12
+    batch_size = 3
+    lengths = [4, 12, 1, 7, 7, 9, 2, 5]
+    embeddings_VD = torch.randn(100, 8, device=device)
+
+    for padding_side in ["left", "right"]:
+        inputs = make_padded_inputs(lengths, context_length, padding_side)
+        inputs = {key: value.to(device) for key, value in inputs.items()}
+
+        batches, sort_indices_b = utils.batch_inputs_by_length(
+            inputs, batch_size, padding_side, pin_memory=device == "cuda"
+        )
+
+        assert len(batches) == 3
+        for batch in batches:
+            # Every batch is trimmed to its longest input and is contiguous, so it can be pinned and copied at once
+            batch_lengths = batch["attention_mask"].sum(1)
+            assert batch["input_ids"].shape[1] == batch_lengths.max()
+            assert all(value.is_contiguous() for value in batch.values())
+            assert all(value.device == inputs["input_ids"].device for value in batch.values())
+
+        pooled_bD = torch.cat([mean_pool(embeddings_VD, batch) for batch in batches])
+        # Undoing the sort must give back the pooled activations of the untrimmed inputs, in their original order
+        pooled_bD = pooled_bD[torch.argsort(sort_indices_b)]
+        assert torch.allclose(pooled_bD, mean_pool(embeddings_VD, inputs), atol=1e-6)
+
+
+def test_load_dictionary(tmp_path):
+    torch.manual_seed(0)
+    model_name = "EleutherAI/pythia-70m-deduped"
+    layer = 1
+    model = SimpleNamespace(
+        config=SimpleNamespace(_name_or_path=model_name, architectures=["GPTNeoXForCausalLM"]),
+        gpt_neox=SimpleNamespace(layers=["layer 0", "layer 1"]),
+    )
+
+    trained_dictionaries = {
+        "AutoEncoder": (AutoEncoder(8, 32), AutoEncoder.from_pretrained, {}),
+        "AutoEncoderTopK": (AutoEncoderTopK(8, 32, k=4), AutoEncoderTopK.from_pretrained, {"k": 4}),
+    }
+
+    for dict_class, (
+        trained_dictionary,
+        from_pretrained,
+        trainer_config,
+    ) in trained_dictionaries.items():
+        # Unnormalized decoder, as saved by the April update trainers
+        with torch.no_grad():
+            trained_dictionary.decoder.weight.mul_(2.0)
+
+        ae_dir = tmp_path / dict_class
+        ae_dir.mkdir()
+        torch.save(trained_dictionary.state_dict(), ae_dir / "ae.pt")
+        config = {
+            "trainer": {
+                "submodule_name": f"resid_post_layer_{layer}",
+                "layer": layer,
+                "lm_name": model_name,
+                "dict_class": dict_class,
+                **trainer_config,
+            }
+        }
+        with open(ae_dir / "config.json", "w") as f:
+            json.dump(config, f)
+
+        submodule, dictionary, loaded_config = utils.load_dictionary(model, str(ae_dir), "cpu")
+
+        assert submodule == f"layer {layer}"
+        assert loaded_config == config
+        # The same dictionary dictionary_learning's own loader builds
+        expected_state_dict = from_pretrained(str(ae_dir / "ae.pt"), device="cpu").state_dict()
+        state_dict = dictionary.state_dict()
+        assert state_dict.keys() == expected_state_dict.keys()
+        for key, value in state_dict.items():
+            assert torch.equal(value, expected_state_dict[key])